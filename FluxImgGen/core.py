@@ -22,15 +22,27 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import asyncio
+import base64
+import contextlib
 import io
 import re
+from collections import OrderedDict
 import random
-from typing import Final, List, Optional
+import time
+from types import MappingProxyType
+from typing import Dict, Final, FrozenSet, List, Mapping, Optional, Tuple
 import aiohttp
 import discord
+import orjson
 from redbot.core import commands
 from redbot.core.bot import Red
 
+_ARG_RE: Final[re.Pattern] = re.compile(r"(?<!\S)--(model|size)=(\S+)\s*")
+_SIZE_CHOICES: Final[Tuple[str, ...]] = ("512x512", "768x768", "1024x1024", "1024x1792", "1792x1024")
+_ALLOWED_SIZES: Final[FrozenSet[str]] = frozenset(_SIZE_CHOICES)
+_FNAME_TABLE: Final[Dict[int, str]] = str.maketrans({c: "_" for c in ' /\\:*?"<>|\t\n\r'})
+
 class DiffusionError(discord.errors.DiscordException):
     pass
 
@@ -38,33 +50,52 @@ class FluxImgGen(commands.Cog):
     __author__: Final[List[str]] = ["tpn"]
     __version__: Final[str] = "0.1.0"
 
+    CACHE_SIZE: Final[int] = 256
+    CACHE_MAX_BYTES: Final[int] = 96 * 1024 * 1024
+    CACHE_TTL: Final[float] = 60.0
+    MAX_IMAGE_BYTES: Final[int] = 25 * 1024 * 1024
+    TIMEOUT: Final[aiohttp.ClientTimeout] = aiohttp.ClientTimeout(total=120, connect=10, sock_read=60)
+    KEEPALIVE_WINDOW: Final[float] = 60.0
+    BUCKET_CAPACITY: Final[float] = 3.0
+    BUCKET_RATE: Final[float] = 1 / 30
+    _NO_REPLY_PING: Final[discord.AllowedMentions] = discord.AllowedMentions(replied_user=False)
+    MODEL_MAPPING: Final[Mapping[str, str]] = MappingProxyType({
+        "base": "flux",
+        "realism": "flux-realism",
+        "3d": "flux-3d",
+        "anime": "flux-anime",
+        "disney": "flux-disney",
+        "pixel": "flux-pixel",
+        "4o": "flux-4o",
+        "anydark": "any-dark",
+        "pro": "flux.1.1-pro-ultra",
+        "sd3": "stable-diffusion-3-large-turbo",
+        "sdxl": "sdxl-lightning-4step",
+        "kandinsky": "kandinsky-3.1",
+        "deliberate3": "deliberate-v3",
+        "rdxl": "realdream-xl",
+        "jugg": "juggernaut-xl-v10",
+        "half": "flux-half-illustration",
+        "recraft": "recraft-v3",
+    })
+
     def __init__(self, bot: Red) -> None:
         self.bot: Red = bot
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession()
-        self.model_mapping = {
-            "base": "flux",
-            "realism": "flux-realism",
-            "3d": "flux-3d",
-            "anime": "flux-anime",
-            "disney": "flux-disney",
-            "pixel": "flux-pixel",
-            "4o": "flux-4o",
-            "anydark": "any-dark",
-            "pro": "flux.1.1-pro-ultra",
-            "sd3": "stable-diffusion-3-large-turbo",
-            "sdxl": "sdxl-lightning-4step",
-            "kandinsky": "kandinsky-3.1",
-            "deliberate3": "deliberate-v3",
-            "rdxl": "realdream-xl",
-            "jugg": "juggernaut-xl-v10",
-            "half": "flux-half-illustration",
-            "recraft": "recraft-v3",
-        }
+        self.api_session: Optional[aiohttp.ClientSession] = None
+        self.cdn_session: Optional[aiohttp.ClientSession] = None
+        self._ka_task: Optional[asyncio.Task] = None
+        self._last_used: float = float("-inf")
+        self._cache: "OrderedDict[Tuple[str, str, str], Tuple[float, bytes]]" = OrderedDict()
+        self._cache_bytes: int = 0
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+        self._inflight: "Dict[Tuple[str, str, str], asyncio.Future[bytes]]" = {}
 
     async def initialize_tokens(self):
         self.tokens = await self.bot.get_shared_api_tokens("flux")
         if not self.tokens.get("model") or not self.tokens.get("size") or not self.tokens.get("endpoint") or not self.tokens.get("key"):
             raise DiffusionError("Setup not done. Use `set api flux key <api_key> set api flux model <default_model>`, `set api flux size <default_size>`, and `set api flux endpoint <baseUrl for api>`.")
+        self._auth_headers: Dict[str, str] = {"Authorization": f"Bearer {self.tokens['key']}"}
+        self._api_url: str = self.tokens["endpoint"].rstrip("/") + "/v1/images/generations"
 
     def format_help_for_context(self, ctx: commands.Context) -> str:
         pre_processed = super().format_help_for_context(ctx) or ""
@@ -76,54 +107,182 @@ class FluxImgGen(commands.Cog):
         ]
         return "\n".join(text)
 
+    @staticmethod
+    def _new_session(limit_per_host: int, headers: Optional[Dict[str, str]] = None) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            headers=headers,
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True,
+            ),
+            timeout=FluxImgGen.TIMEOUT,
+            json_serialize=lambda obj: orjson.dumps(obj).decode(),
+        )
+
+    def _get_api_session(self) -> aiohttp.ClientSession:
+        if self.api_session is None or self.api_session.closed:
+            self.api_session = self._new_session(limit_per_host=32, headers=self._auth_headers)
+        return self.api_session
+
+    def _get_cdn_session(self) -> aiohttp.ClientSession:
+        if self.cdn_session is None or self.cdn_session.closed:
+            self.cdn_session = self._new_session(limit_per_host=16)
+        return self.cdn_session
+
     async def cog_load(self) -> None:
         await self.initialize_tokens()
+        self._get_api_session()
+        self._get_cdn_session()
+        self._ka_task = asyncio.create_task(self._keepalive())
+
+    async def _keepalive(self) -> None:
+        # Providers often close idle connections well before our keepalive_timeout, so keep the
+        # pooled connection warm, but only while the command is actually being used.
+        while True:
+            await asyncio.sleep(10)
+            if time.monotonic() - self._last_used > self.KEEPALIVE_WINDOW:
+                continue
+            try:
+                async with self._get_api_session().head(self.tokens["endpoint"], timeout=aiohttp.ClientTimeout(total=5)):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
 
     async def cog_unload(self) -> None:
-        if self.session:
-            await self.session.close()
+        if self._ka_task:
+            self._ka_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._ka_task
+        if self.api_session:
+            await self.api_session.close()
+        if self.cdn_session:
+            await self.cdn_session.close()
 
-    async def _request(self, baseUrl: str, prompt: str, model: str, size: str) -> bytes:
+    async def _request(self, prompt: str, model: str, size: str) -> io.BytesIO:
         data = {
             "prompt": prompt,
             "n": 1,
             "size": size,
-            "response_format": "url",
+            "response_format": "b64_json",
             "model": model
         }
-        
-        key = self.tokens.get("key")
-        headers = {
-            "Authorization": f"Bearer {key}"
-        }
-        url = f"{baseUrl}/v1/images/generations"
-        
-        async with self.session.post(url, json=data, headers=headers) as response:
-            content = await response.json()
-
-            if not response.ok:
-                raise DiffusionError(f"Error?: {response.status}")
-            
-            image_url = content["data"][0]["url"]
-            async with self.session.get(image_url) as img_response:
-                return await img_response.read()
-
-    async def _generate_image(self, prompt: str, model: Optional[str], size: Optional[str]) -> bytes:
-        default_model = self.tokens["model"]
-        default_size = self.tokens["size"]
-        baseUrl = self.tokens["endpoint"]
-
-        size = size or default_size
-        model = model or default_model
-        if model.lower() not in self.model_mapping:
+
+        self._last_used = time.monotonic()
+        try:
+            async with self._get_api_session().post(self._api_url, json=data) as response:
+                content = await response.json(loads=orjson.loads)
+
+                if not response.ok:
+                    raise DiffusionError(f"Error?: {response.status}")
+                
+                image = content["data"][0]
+                if "b64_json" in image:
+                    image_data = await asyncio.get_running_loop().run_in_executor(None, base64.b64decode, image["b64_json"])
+                    if len(image_data) > self.MAX_IMAGE_BYTES:
+                        raise DiffusionError("Generated image is too large.")
+                    return io.BytesIO(image_data)
+
+                # Some providers ignore response_format and only return a url.
+                image_url = image["url"]
+                async with self._get_cdn_session().get(image_url) as img_response:
+                    if (img_response.content_length or 0) > self.MAX_IMAGE_BYTES:
+                        raise DiffusionError("Generated image is too large.")
+                    buf = io.BytesIO()
+                    async for chunk in img_response.content.iter_chunked(65536):
+                        if buf.tell() + len(chunk) > self.MAX_IMAGE_BYTES:
+                            raise DiffusionError("Generated image is too large.")
+                        buf.write(chunk)
+                    buf.seek(0)
+                    return buf
+        except asyncio.TimeoutError:
+            raise DiffusionError("Upstream timeout.")
+
+    def _resolve_model(self, model: Optional[str]) -> str:
+        model = model or self.tokens["model"]
+        mapped = self.MODEL_MAPPING.get(model.lower())
+        if mapped is None:
             raise DiffusionError(f"Model `{model}` does not exist.")
-        model = self.model_mapping.get(model.lower(), model)
-        return await self._request(baseUrl, prompt, model, size)
+        return mapped
+
+    async def _generate_image(self, prompt: str, model: str, size: Optional[str]) -> io.BytesIO:
+        size = size or self.tokens["size"]
+        key = (model, size, prompt.strip().lower())
+        cached = self._cache_get(key)
+        if cached is not None:
+            return io.BytesIO(cached)
 
-    async def _image_to_file(self, image_data: bytes, prompt: str) -> discord.File:
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # Shield so a waiter being cancelled doesn't cancel the shared generation.
+            return io.BytesIO(await asyncio.shield(inflight))
+
+        fut: "asyncio.Future[bytes]" = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            buf = await self._request(prompt, model, size)
+        except asyncio.CancelledError:
+            # Waiters weren't cancelled themselves, so give them an error _gen can report.
+            fut.set_exception(DiffusionError("The shared generation for this prompt was cancelled, try again."))
+            fut.exception()  # mark retrieved when nobody else was waiting
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        image_data = buf.getvalue()
+        self._cache_put(key, image_data)
+        fut.set_result(image_data)
+        return buf
+
+    def _cache_get(self, key: Tuple[str, str, str]) -> Optional[bytes]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, image_data = entry
+        if time.monotonic() - stored_at > self.CACHE_TTL:
+            # Expired so that re-sending a prompt later produces a new variant.
+            del self._cache[key]
+            self._cache_bytes -= len(image_data)
+            return None
+        self._cache.move_to_end(key)
+        return image_data
+
+    def _cache_put(self, key: Tuple[str, str, str], image_data: bytes) -> None:
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._cache_bytes -= len(old[1])
+        if len(image_data) > self.CACHE_MAX_BYTES:
+            return
+        self._cache[key] = (time.monotonic(), image_data)
+        self._cache_bytes += len(image_data)
+        while len(self._cache) > self.CACHE_SIZE or self._cache_bytes > self.CACHE_MAX_BYTES:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+
+    def _consume_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        # A missing entry means a full bucket, so drop the ones that have refilled.
+        for uid, (tokens, last) in list(self._buckets.items()):
+            if tokens + self.BUCKET_RATE * (now - last) >= self.BUCKET_CAPACITY:
+                del self._buckets[uid]
+        tokens, last = self._buckets.get(user_id, (self.BUCKET_CAPACITY, now))
+        tokens = min(self.BUCKET_CAPACITY, tokens + self.BUCKET_RATE * (now - last))
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+        return True
+
+    async def _image_to_file(self, image_data: io.BytesIO, prompt: str) -> discord.File:
         return discord.File(
-            io.BytesIO(image_data),
-            filename=f"{prompt.replace(' ', '_')}.png"
+            image_data,
+            filename=f"{prompt.translate(_FNAME_TABLE)[:80] or 'image'}.png"
         )
 
     @commands.command(name="flux", aliases=["f"])
@@ -132,7 +291,9 @@ class FluxImgGen(commands.Cog):
         **Arguments:**
         - `<prompt>` - A detailed description of the image you want to create.
         - `--model` - Choose the specific model to use for image generation.
-        - `--size` - Resoultion for the generated image.
+        - `--size` - Resoultion for the generated image. One of `512x512`, `768x768`, `1024x1024`, `1024x1792`, `1792x1024`.
+
+        Sending the exact same prompt again within a minute returns the previous image.
         
         **Models:**
         - `base` - Base flux model.
@@ -153,46 +314,66 @@ class FluxImgGen(commands.Cog):
         - `half` - Flux Half Illustration lora. Use "in the style of TOK" to trigger generation, creates half photo half illustrated elements.
         - `recraft` - Recraft V3.
         """
-        await ctx.typing()
-        args_list = args.split(" ")
+        ref = ctx.message.to_reference(fail_if_not_exists=False)
         model = None
         size = None
-        prompt_parts = []
-
-        for arg in args_list:
-            if arg.startswith("--model="):
-                model = arg.split("=")[1]
-            elif arg.startswith("--size="):
-                size = arg.split("=")[1]
-                if not re.match(r"^\d+x\d+$", size):
-                    await ctx.send("Invalid size value. Please provide a valid resolution in the format 'width:height' (e.g., '1920x1080').")
-                    return
+        for match in _ARG_RE.finditer(args):
+            if match.group(1) == "model":
+                model = match.group(2)
             else:
-                prompt_parts.append(arg)
+                size = match.group(2)
 
-        prompt = " ".join(prompt_parts)
+        if size is not None and size not in _ALLOWED_SIZES:
+            await ctx.send(
+                f"Unsupported size. Please use one of: {', '.join(_SIZE_CHOICES)}.",
+                reference=ref,
+                allowed_mentions=self._NO_REPLY_PING,
+            )
+            return
+
+        prompt = _ARG_RE.sub("", args).strip()
+        display_model = model or self.tokens["model"]
 
         try:
-            image_data = await self._generate_image(prompt, model, size)
+            model = self._resolve_model(model)
         except DiffusionError as e:
             await ctx.send(
                 f"Something went wrong...\n{e}",
-                reference=ctx.message.to_reference(fail_if_not_exists=False),
-                allowed_mentions=discord.AllowedMentions(replied_user=False),
+                reference=ref,
+                allowed_mentions=self._NO_REPLY_PING,
             )
             return
-        except aiohttp.ClientResponseError as e:
+
+        if not self._consume_token(ctx.author.id):
             await ctx.send(
-                f"Error?: `{e.status}`\n{e.message}",
-                reference=ctx.message.to_reference(fail_if_not_exists=False),
-                allowed_mentions=discord.AllowedMentions(replied_user=False),
+                "You're generating images too quickly, try again in a bit.",
+                reference=ref,
+                allowed_mentions=self._NO_REPLY_PING,
             )
             return
-        file: discord.File = await self._image_to_file(image_data, prompt)
-        await ctx.send(
-            embed=discord.Embed(
-                description=f"Prompt: {prompt}; Model: {model if model else self.tokens.get('model')};",
-                color=await ctx.embed_color(),
-            ),
-            file=file,
-        )
\ No newline at end of file
+
+        async with ctx.typing():
+            try:
+                image_data = await self._generate_image(prompt, model, size)
+            except DiffusionError as e:
+                await ctx.send(
+                    f"Something went wrong...\n{e}",
+                    reference=ref,
+                    allowed_mentions=self._NO_REPLY_PING,
+                )
+                return
+            except aiohttp.ClientResponseError as e:
+                await ctx.send(
+                    f"Error?: `{e.status}`\n{e.message}",
+                    reference=ref,
+                    allowed_mentions=self._NO_REPLY_PING,
+                )
+                return
+            file: discord.File = await self._image_to_file(image_data, prompt)
+            await ctx.send(
+                embed=discord.Embed(
+                    description=f"Prompt: {prompt}; Model: {display_model};",
+                    color=await ctx.embed_color(),
+                ),
+                file=file,
+            )